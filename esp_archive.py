@@ -0,0 +1,253 @@
+# esp-bin2elf written by Joel Sandin <jsandin@gmail.com>
+#
+# MIT licence
+
+# Deduplicating archive of flash dumps.
+#
+# Dumps are split into 4k flash sectors and every unique sector is stored
+# once, named by its sha256 (optionally zlib compressed).  Each dump is a
+# small manifest listing its sector hashes, so the same SDK, bootloader and
+# erased (0xff) sectors repeated across a fleet only take up space once.
+#
+# open_dump() rebuilds a dump on demand as a file-like object which can be
+# handed straight to EspRom.
+#
+# layout:  archive_dir/sectors/ab/abcdef...[.z]
+#          archive_dir/dumps/<name>.manifest
+
+import hashlib
+import io
+import os
+import zlib
+
+from struct import Struct
+
+FLASH_SECTOR_SIZE = 0x1000
+
+# manifest = magic | version | dump length | sha256 digest per sector
+MANIFEST_MAGIC = b'ESPA'
+MANIFEST_VERSION = 1
+manifest_header = Struct('<4sIQ')
+DIGEST_SIZE = 32
+
+class SectorArchive(object):
+    def __init__(self, archive_dir, compress=False, compress_level=6):
+        self.archive_dir = archive_dir
+        self.compress = compress
+        self.compress_level = compress_level
+
+        self.stored_sectors = 0
+        self.duplicate_sectors = 0
+
+        for subdir in ('sectors', 'dumps'):
+            path = os.path.join(archive_dir, subdir)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def add_dump(self, dump_name, dump_bytes):
+        dump_view = memoryview(dump_bytes)
+        digests = []
+
+        for offset in range(0, len(dump_view), FLASH_SECTOR_SIZE):
+            sector = dump_view[offset:offset + FLASH_SECTOR_SIZE]
+            digest = hashlib.sha256(sector).digest()
+            self._store_sector(digest, sector)
+            digests.append(digest)
+
+        manifest = manifest_header.pack(MANIFEST_MAGIC, MANIFEST_VERSION, len(dump_view))
+        manifest += b''.join(digests)
+        _write_atomically(self._manifest_path(dump_name), manifest)
+
+    def open_dump(self, dump_name):
+        path = self._manifest_path(dump_name)
+
+        if not os.path.exists(path):
+            raise ArchiveException(
+                "SectorArchive.open_dump(): no dump named %s" % (dump_name))
+
+        with open(path, 'rb') as f:
+            manifest = f.read()
+
+        if len(manifest) < manifest_header.size:
+            raise ArchiveException(
+                "SectorArchive.open_dump(): manifest for %s is truncated" % (dump_name))
+
+        magic, version, length = manifest_header.unpack_from(manifest)
+
+        if magic != MANIFEST_MAGIC or version != MANIFEST_VERSION:
+            raise ArchiveException(
+                "SectorArchive.open_dump(): bad manifest for %s" % (dump_name))
+
+        digests = [manifest[offset:offset + DIGEST_SIZE]
+                   for offset in range(manifest_header.size, len(manifest), DIGEST_SIZE)]
+
+        if len(digests) != (length + FLASH_SECTOR_SIZE - 1) // FLASH_SECTOR_SIZE:
+            raise ArchiveException(
+                "SectorArchive.open_dump(): manifest for %s has %d sectors for %d bytes"
+                    % (dump_name, len(digests), length))
+
+        return ArchivedDump(self, digests, length)
+
+    def list_dumps(self):
+        return sorted(filename[:-len('.manifest')]
+                      for filename in os.listdir(os.path.join(self.archive_dir, 'dumps'))
+                      if filename.endswith('.manifest'))
+
+    def read_sector(self, digest):
+        path = self._sector_path(digest)
+
+        if os.path.exists(path + '.z'):
+            with open(path + '.z', 'rb') as f:
+                sector = zlib.decompress(f.read())
+        elif os.path.exists(path):
+            with open(path, 'rb') as f:
+                sector = f.read()
+        else:
+            raise ArchiveException(
+                "SectorArchive.read_sector(): missing sector %s" % (digest.hex()))
+
+        if hashlib.sha256(sector).digest() != digest:
+            raise ArchiveException(
+                "SectorArchive.read_sector(): sector %s is corrupt" % (digest.hex()))
+
+        return sector
+
+    def _store_sector(self, digest, sector):
+        path = self._sector_path(digest)
+
+        # a sector may have been stored compressed or not by earlier runs
+        if os.path.exists(path) or os.path.exists(path + '.z'):
+            self.duplicate_sectors += 1
+            return
+
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        if self.compress:
+            _write_atomically(path + '.z', zlib.compress(sector, self.compress_level))
+        else:
+            _write_atomically(path, sector)
+
+        self.stored_sectors += 1
+
+    def _sector_path(self, digest):
+        name = digest.hex()
+        return os.path.join(self.archive_dir, 'sectors', name[:2], name)
+
+    def _manifest_path(self, dump_name):
+        if os.sep in dump_name or (os.altsep and os.altsep in dump_name):
+            raise ArchiveException(
+                "SectorArchive: dump name %s contains a path separator" % (dump_name))
+
+        return os.path.join(self.archive_dir, 'dumps', dump_name + '.manifest')
+
+    def __str__(self):
+        rep = "SectorArchive("
+        rep += "archive_dir: %s, " % (self.archive_dir)
+        rep += "compress: %s, " % (self.compress)
+        rep += "stored_sectors: %d, " % (self.stored_sectors)
+        rep += "duplicate_sectors: %d)" % (self.duplicate_sectors)
+
+        return rep
+
+
+class ArchivedDump(io.RawIOBase):
+    # read-only, seekable view of an archived dump, sectors are read from
+    # the archive as they are needed
+
+    def __init__(self, archive, digests, length):
+        super(ArchivedDump, self).__init__()
+
+        self.archive = archive
+        self.digests = digests
+        self.length = length
+        self.position = 0
+
+        # dumps repeat the same sectors (erased flash especially), keep
+        # the ones already read rather than going back to disk
+        self.sectors = {}
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.length + offset
+        else:
+            raise ValueError("ArchivedDump.seek(): invalid whence %d" % (whence))
+
+        if position < 0:
+            raise ValueError("ArchivedDump.seek(): negative position %d" % (position))
+
+        self.position = position
+        return position
+
+    def readinto(self, buf):
+        view = memoryview(buf).cast('B')
+        count = 0
+
+        while count < len(view) and self.position < self.length:
+            index, sector_offset = divmod(self.position, FLASH_SECTOR_SIZE)
+            sector = self._sector(index)
+
+            chunk = min(len(view) - count, len(sector) - sector_offset)
+            view[count:count + chunk] = sector[sector_offset:sector_offset + chunk]
+
+            count += chunk
+            self.position += chunk
+
+        return count
+
+    def readall(self):
+        contents = bytearray(max(self.length - self.position, 0))
+        count = self.readinto(contents)
+        del contents[count:]
+        return bytes(contents)
+
+    def _sector(self, index):
+        digest = self.digests[index]
+
+        if digest not in self.sectors:
+            self.sectors[digest] = memoryview(self.archive.read_sector(digest))
+
+        sector = self.sectors[digest]
+
+        # only the last sector may be short, a manifest pointing at some
+        # other dump's short tail sector would otherwise never finish reading
+        if index == len(self.digests) - 1:
+            expected_size = self.length - index * FLASH_SECTOR_SIZE
+        else:
+            expected_size = FLASH_SECTOR_SIZE
+
+        if len(sector) != expected_size:
+            raise ArchiveException(
+                "ArchivedDump.readinto(): sector %d (%s) is %d bytes, expected %d"
+                    % (index, digest.hex(), len(sector), expected_size))
+
+        return sector
+
+
+class ArchiveException(Exception):
+    pass
+
+
+def _write_atomically(path, contents):
+    # concurrent writers store identical contents under the same name, so
+    # whichever rename lands last is fine
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+
+    with open(temp_path, 'wb') as f:
+        f.write(contents)
+
+    os.rename(temp_path, path)
@@ -5,13 +5,27 @@
 # based on the excellent reversing / writeup from Richard Burton:
 # http://richard.burtons.org/2015/05/17/esp8266-boot-process/
 
-from esp_rom import EspRom
-from esp_elf import XtensaElf, ElfSection, default_section_settings
+from esp_rom import EspRom, ParseBudget
+from esp_elf import XtensaElf, ElfSection, default_section_settings, STB_LOCAL, STT_OBJECT
 from esp_bootrom import get_bootrom_contents, symbols
+from esp_archive import SectorArchive
+from esp_cache import ConversionCache
+from esp_strings import find_strings
 
-def parse_rom(rom_name, rom_filename, flash_layout):
-    with open(rom_filename) as f:
-        rom = EspRom(rom_name, f, flash_layout)
+def parse_rom(rom_name, rom_filename, flash_layout, archive=None, budget=None):
+    with open(rom_filename, 'rb') as f:
+        rom = EspRom(rom_name, f, flash_layout, budget)
+
+    # optionally keep the dump in a deduplicating SectorArchive
+    if archive:
+        archive.add_dump(rom_name, rom.contents)
+
+    return rom
+
+
+def parse_archived_rom(rom_name, archive, flash_layout, budget=None):
+    with archive.open_dump(rom_name) as f:
+        rom = EspRom(rom_name, f, flash_layout, budget)
 
     return rom
 
@@ -19,20 +33,22 @@ def parse_rom(rom_name, rom_filename, flash_layout):
 def name_sections(rom):
     addr_to_section_name_mapping = {}
 
-    print "select a unique name for each section in the rom."
-    print "sensible defaults are available for the following common names:"
-    print " ".join(default_section_settings.keys())
-    print "if defaults are unavailable for a name, generic values will be used."
+    print("select a unique name for each section in the rom.")
+    print("sensible defaults are available for the following common names:")
+    print(" ".join(default_section_settings.keys()))
+    print("if defaults are unavailable for a name, generic values will be used.")
 
     for section in rom.sections:
-        name = raw_input("enter a name for 0x%04x> " % (section.address))
+        name = input("enter a name for 0x%04x> " % (section.address))
         addr_to_section_name_mapping[section.address] = name
 
     return addr_to_section_name_mapping
 
 
-def convert_rom_to_elf(esp_rom, addr_to_section_name_mapping, filename_to_write=None):
-    elf = XtensaElf(esp_rom.name + '.elf', esp_rom.header.entry_addr)
+def convert_rom_to_elf(esp_rom, addr_to_section_name_mapping, filename_to_write=None,
+                       sort_symbols=False, hash_sections=False, string_symbols=False):
+    elf = XtensaElf(esp_rom.name + '.elf', esp_rom.header.entry_addr,
+                    sort_symbols, hash_sections)
 
     bootrom_bytes = get_bootrom_contents()
     bootrom_section = ElfSection('.bootrom.text', 0x40000000, bootrom_bytes)
@@ -40,14 +56,19 @@ def convert_rom_to_elf(esp_rom, addr_to_section_name_mapping, filename_to_write=
 
     for section in esp_rom.sections:
         if section.address not in addr_to_section_name_mapping:
-            print "generation failed: no name for 0x%04x." % (section.address)
+            print("generation failed: no name for 0x%04x." % (section.address))
             return None
 
         name = addr_to_section_name_mapping[section.address]
         elf_section = ElfSection(name, section.address, section.contents)
         elf.add_section(elf_section, True)
 
-    for name, addr in symbols.iteritems():
+        if string_symbols:
+            for rom_string in find_strings(section):
+                elf.add_symbol(rom_string.symbol_name(), rom_string.address, name,
+                               STB_LOCAL, STT_OBJECT, len(rom_string.string) + 1)
+
+    for name, addr in symbols.items():
         elf.add_symbol(name, addr, '.bootrom.text')
 
     elf.generate_elf()
@@ -56,3 +77,23 @@ def convert_rom_to_elf(esp_rom, addr_to_section_name_mapping, filename_to_write=
         elf.write_to_file(filename_to_write)
 
     return elf
+
+
+def convert_rom_to_elf_cached(cache, esp_rom, addr_to_section_name_mapping,
+                              filename_to_write=None, sort_symbols=False,
+                              hash_sections=False, string_symbols=False):
+    # returns the path of the cached ELF, filename_to_write is a hard link
+    # to it (or a copy when linking isn't possible)
+    key = cache.key_for(esp_rom, addr_to_section_name_mapping, symbols,
+                        sort_symbols, hash_sections, string_symbols)
+
+    path = cache.get(key, filename_to_write)
+    if path:
+        return path
+
+    elf = convert_rom_to_elf(esp_rom, addr_to_section_name_mapping, None,
+                             sort_symbols, hash_sections, string_symbols)
+    if elf is None:
+        return None
+
+    return cache.put(key, elf, filename_to_write)
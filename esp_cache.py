@@ -0,0 +1,172 @@
+# esp-bin2elf written by Joel Sandin <jsandin@gmail.com>
+#
+# MIT licence
+
+# On-disk cache of converted ELF files.
+#
+# Entries are keyed by a hash of the dump contents plus everything else
+# that affects the generated ELF: the flash layout, the section names,
+# the symbol set and the symbol table / string symbol options.  The
+# cache is bounded in size; when it grows past max_size the least
+# recently used entries (by file mtime, refreshed on every hit) are
+# evicted.
+
+import hashlib
+import os
+import shutil
+
+# bump this whenever the generated ELF changes for the same inputs
+CACHE_VERSION = 2
+
+class ConversionCache(object):
+    def __init__(self, cache_dir, max_size=1024 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_size = max_size   # in bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key_for(self, esp_rom, addr_to_section_name_mapping, symbols,
+                sort_symbols=False, hash_sections=False, string_symbols=False):
+        key = hashlib.sha256()
+        key.update(esp_rom.contents)
+
+        layout = sorted((name, section.offset, section.size)
+                        for name, section in esp_rom.flash_layout.items())
+
+        key.update(repr((CACHE_VERSION,
+                         layout,
+                         sorted(addr_to_section_name_mapping.items()),
+                         sorted(symbols.items()),
+                         sort_symbols,
+                         hash_sections,
+                         string_symbols)).encode('utf-8'))
+
+        return key.hexdigest()
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, key + '.elf')
+
+    def get(self, key, filename_to_write=None):
+        path = self.path_for(key)
+
+        try:
+            os.utime(path, None)   # mark as recently used
+        except FileNotFoundError:
+            # missing, or evicted by another process since
+            self.misses += 1
+            return None
+
+        self.hits += 1
+
+        # errors writing the output are the caller's, not a cache miss
+        if filename_to_write:
+            _link_or_copy(path, filename_to_write)
+
+        return path
+
+    def put(self, key, xtensa_elf, filename_to_write=None):
+        path = self.path_for(key)
+
+        # write to a temporary name first so a concurrent reader never
+        # sees a partially written entry
+        temp_path = '%s.%s.tmp' % (path, os.urandom(8).hex())
+
+        try:
+            xtensa_elf.write_to_file(temp_path)
+
+            # outputs are hard links to the entry, make it read-only so other
+            # tools can't write through them (write_to_file replaces instead)
+            os.chmod(temp_path, 0o444)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.lexists(temp_path):
+                os.remove(temp_path)
+
+        if filename_to_write:
+            _link_or_copy(path, filename_to_write)
+
+        self.evict(keep=path)
+
+        return path
+
+    def evict(self, keep=None):
+        entries = []
+        total_size = 0
+
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith('.elf'):
+                continue
+
+            path = os.path.join(self.cache_dir, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue   # removed by another process
+
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+
+        entries.sort()
+
+        for mtime, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            if path == keep:
+                continue
+
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+
+            total_size -= size
+            self.evictions += 1
+
+    def __str__(self):
+        rep = "ConversionCache("
+        rep += "cache_dir: %s, " % (self.cache_dir)
+        rep += "max_size: %d, " % (self.max_size)
+        rep += "hits: %d, " % (self.hits)
+        rep += "misses: %d, " % (self.misses)
+        rep += "evictions: %d)" % (self.evictions)
+
+        return rep
+
+
+def _link_or_copy(source, destination):
+    # link or copy to a new temporary name and move it into place, an
+    # existing destination is replaced rather than written through
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+        return   # already linked to this entry
+
+    temp_destination = '%s.%s.tmp' % (destination, os.urandom(8).hex())
+    created = False
+
+    try:
+        try:
+            # fails rather than overwrites if the name is already taken
+            os.link(source, temp_destination)
+            created = True
+        except OSError:
+            if not os.path.exists(source):
+                raise
+            # different filesystem, or no hard link support
+            with open(source, 'rb') as f_in, _create_new(temp_destination) as f_out:
+                created = True
+                shutil.copyfileobj(f_in, f_out)
+
+        os.replace(temp_destination, destination)
+    finally:
+        if created and os.path.lexists(temp_destination):
+            os.remove(temp_destination)
+
+
+def _create_new(path):
+    # O_EXCL: never open (and write through) a file that already exists
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    return os.fdopen(os.open(path, flags, 0o666), 'wb')
@@ -6,15 +6,28 @@ from elffile import ElfFileIdent, ElfFileHeader32l, ElfFile32l, ElfSectionHeader
 from esp_elf_pack import pack_elf, pack_symbol
 from esp_memory_map import is_code, is_data
 
+import os
+
+from struct import pack
+
+# symbol bindings:
+STB_LOCAL    = 0
+STB_GLOBAL   = 1
+
+# symbol types:
+STT_NOTYPE   = 0
+STT_OBJECT   = 1
+STT_FUNC     = 2
+
 class XtensaElf(object):
-    def __init__(self, elf_name, entry_addr):
+    def __init__(self, elf_name, entry_addr, sort_symbols=False, hash_sections=False):
         ident = ElfFileIdent()
 
         ident.abiversion = 0         # 0
         ident.elfClass =  1          # ELFCLASS32
         ident.elfData = 1            # ELFDATA2LSB
         ident.fileVersion = 1        # 1
-        ident.magic = '\x7fELF'      # ELF'
+        ident.magic = b'\x7fELF'     # ELF'
         ident.osabi = 0              # 0
 
         header = ElfFileHeader32l()
@@ -37,17 +50,31 @@ class XtensaElf(object):
         self.elf.fileHeader = header
 
         self.string_table = ElfStringTable()
-        self.symbol_table = ElfSymbolTable()
+        self.symbol_table = ElfSymbolTable(sort_symbols)
+
+        # .hash and .gnu.hash let consumers look up a symbol by name
+        # without scanning the whole symbol table
+        if hash_sections:
+            self.hash_tables = [ElfHashTable(), ElfGnuHashTable()]
+        else:
+            self.hash_tables = []
 
         self.sections = []
         self.add_section(NullSection(), True) # generate null ph entry
         self.add_section(self.string_table)
         self.add_section(self.symbol_table)
 
+        for hash_table in self.hash_tables:
+            self.add_section(hash_table)
+
         string_table_offset = self.get_index_for_section('.shstrtab')
         self.symbol_table.set_link(string_table_offset)
         self.elf.fileHeader.shstrndx = string_table_offset
 
+        symbol_table_offset = self.get_index_for_section('.symtab')
+        for hash_table in self.hash_tables:
+            hash_table.set_link(symbol_table_offset)
+
     def add_section(self, esp_section, add_to_program_header=False):
         nameoffset = self.string_table.add_string(esp_section.header.name)
         esp_section.header.nameoffset = nameoffset
@@ -61,8 +88,10 @@ class XtensaElf(object):
             self.elf.programHeaders.append(esp_section.program_header)
             self.elf.fileHeader.phnum += 1
 
-    def add_symbol(self, symbol_name, symbol_address, section_name):
-        self.symbol_table.add_symbol(symbol_name, symbol_address, section_name)
+    def add_symbol(self, symbol_name, symbol_address, section_name,
+                   binding=STB_GLOBAL, symbol_type=STT_FUNC, symbol_size=0):
+        self.symbol_table.add_symbol(symbol_name, symbol_address, section_name,
+                                     binding, symbol_type, symbol_size)
 
     def get_index_for_section(self, section_name):
         for index, section in enumerate(self.elf.sectionHeaders):
@@ -77,10 +106,15 @@ class XtensaElf(object):
         # generate symbol table
         self.symbol_table.generate_content(self)
 
+        for hash_table in self.hash_tables:
+            hash_table.generate_content(self.symbol_table)
+
         # compute offsets for section contents, sections, and program headers
         offset = self.elf.fileHeader.ehsize
 
         for section in self.sections:
+            # pad so tables like .hash can be read in place as uint32 arrays
+            offset = _align(offset, section.header.addralign)
             section.header.offset = offset
 
             if section.program_header:
@@ -89,13 +123,34 @@ class XtensaElf(object):
             offset += section.header.section_size
 
         # write section and program headers after contents
+        offset = _align(offset, 4)
         self.elf.fileHeader.shoff = offset
         offset += self.elf.fileHeader.shentsize * self.elf.fileHeader.shnum
         self.elf.fileHeader.phoff = offset
 
     def write_to_file(self, filename_to_write):
-        with open(filename_to_write, 'w') as f:
-            f.write(pack_elf(self.elf))
+        # write a new file and move it into place, so an existing file at
+        # filename_to_write (possibly a hard link into a ConversionCache)
+        # is replaced rather than written through
+        temp_filename = '%s.%s.tmp' % (filename_to_write, os.urandom(8).hex())
+
+        # O_EXCL: never open (and write through) a file that already exists
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+
+        try:
+            with os.fdopen(os.open(temp_filename, flags, 0o666), 'wb') as f:
+                f.write(pack_elf(self.elf))
+
+            os.replace(temp_filename, filename_to_write)
+        finally:
+            if os.path.lexists(temp_filename):
+                os.remove(temp_filename)
+
+
+def _align(offset, alignment):
+    if alignment > 1:
+        offset += -offset % alignment
+    return offset
 
 
 class ElfSection(object):
@@ -118,7 +173,7 @@ class ElfSection(object):
         elif is_data(section_address):
             settings_to_use = dataSettings
         else:
-            raise Exception("can't find settings for %x" % (section_adddress))
+            raise Exception("can't find settings for %x" % (section_address))
 
         header.type = settings_to_use.type
         header.addralign = settings_to_use.addralign
@@ -127,8 +182,9 @@ class ElfSection(object):
         self.header = header
         self.program_header = None
 
-    def append_to_content(self, string):
-        self.header.content += string
+    def append_to_content(self, content_bytes):
+        # tables that grow are backed by a bytearray, extended in place
+        self.header.content += content_bytes
         self.header.section_size = len(self.header.content)
 
     def generate_program_header(self):
@@ -153,19 +209,19 @@ class ElfSection(object):
 
 class NullSection(ElfSection):
     def __init__(self):
-        super(NullSection, self).__init__('', 0x0, '')
+        super(NullSection, self).__init__('', 0x0, b'')
 
 
 class ElfStringTable(ElfSection):
     def __init__(self):
         self.string_to_offset = {'': 0}
 
-        super(ElfStringTable, self).__init__('.shstrtab', 0x0, '\x00')
+        super(ElfStringTable, self).__init__('.shstrtab', 0x0, bytearray(b'\x00'))
 
     def add_string(self, string):
         if string not in self.string_to_offset:
             self.string_to_offset[string] = len(self.header.content)
-            self.append_to_content(string + '\x00')
+            self.append_to_content(string.encode('utf-8') + b'\x00')
 
         return self.get_index(string)
 
@@ -174,34 +230,64 @@ class ElfStringTable(ElfSection):
 
 
 class ElfSymbolTable(ElfSection):
-    def __init__(self):
-        super(ElfSymbolTable, self).__init__('.symtab', 0x0, '')
+    def __init__(self, sort_symbols=False):
+        super(ElfSymbolTable, self).__init__('.symtab', 0x0, bytearray())
 
-        self.append_to_content('\x00' * 16)   # first entry is null symbol
+        self.append_to_content(b'\x00' * 16)  # first entry is null symbol
         self.header.entsize = 16              # sizeof(Elf32_sym)
+        self.sort_symbols = sort_symbols
         self.symbols = []
+        self.symbol_names = ['']              # names in symbol table order
 
     def set_link(self, link):
         self.header.link = link               # index of .shstrtab
 
-    def add_symbol(self, name, address, section_name):
-        self.symbols.append((name, address, section_name))
+    def add_symbol(self, name, address, section_name,
+                   binding=STB_GLOBAL, symbol_type=STT_FUNC, size=0):
+        self.symbols.append((name, address, section_name, binding, symbol_type, size))
 
     def generate_content(self, elf):
+        local_symbols = []
+        global_symbols = []
+
         for symbol in self.symbols:
-            name, address, section_name = symbol
-            offset = elf.string_table.add_string(name)
+            name, address, section_name, binding, symbol_type, size = symbol
             section_index = elf.get_index_for_section(section_name)
-            entry = SymbolTableEntry(offset, address, section_index)
+            entry = (section_index, address, name, binding, symbol_type, size)
+
+            if binding == STB_LOCAL:
+                local_symbols.append(entry)
+            else:
+                global_symbols.append(entry)
+
+        if self.sort_symbols:
+            local_symbols.sort()
+            global_symbols.sort()
+
+        # .gnu.hash requires the global symbols to be grouped by bucket
+        for hash_table in elf.hash_tables:
+            global_symbols = hash_table.order_symbols(global_symbols)
+
+        # locals must precede globals, sh_info is the index of the first
+        # global (the null symbol at index 0 counts as a local)
+        self.header.info = 1 + len(local_symbols)
+
+        for symbol in local_symbols + global_symbols:
+            section_index, address, name, binding, symbol_type, size = symbol
+            offset = elf.string_table.add_string(name)
+            entry = SymbolTableEntry(offset, address, section_index,
+                                     binding, symbol_type, size)
             self.append_to_content(entry.pack())
+            self.symbol_names.append(name)
 
 
 class SymbolTableEntry(object):
-    def __init__(self, symbol_name_offset, symbol_address, section_index):
+    def __init__(self, symbol_name_offset, symbol_address, section_index,
+                 binding=STB_GLOBAL, symbol_type=STT_FUNC, symbol_size=0):
         self.st_name = symbol_name_offset
         self.st_value = symbol_address
-        self.st_size = 0
-        self.st_info = (1 << 4) + 2   # STB_GLOBAL, STT_FUNC
+        self.st_size = symbol_size
+        self.st_info = (binding << 4) + symbol_type
         self.st_other = 0
         self.st_shndx = section_index
 
@@ -209,6 +295,113 @@ class SymbolTableEntry(object):
         return pack_symbol(self)
 
 
+class ElfHashTable(ElfSection):
+    # SysV .hash: nbucket, nchain, bucket[nbucket], chain[nchain]
+
+    def __init__(self):
+        super(ElfHashTable, self).__init__('.hash', 0x0, bytearray())
+
+        self.header.entsize = 4
+
+    def set_link(self, link):
+        self.header.link = link               # index of .symtab
+
+    def order_symbols(self, global_symbols):
+        return global_symbols
+
+    def generate_content(self, symbol_table):
+        names = symbol_table.symbol_names
+        nbucket = choose_bucket_count(len(names))
+        buckets = [0] * nbucket
+        chains = [0] * len(names)
+
+        for index in range(1, len(names)):
+            bucket = elf_hash(names[index]) % nbucket
+            chains[index] = buckets[bucket]
+            buckets[bucket] = index
+
+        words = [nbucket, len(names)] + buckets + chains
+        self.append_to_content(pack('<%dI' % len(words), *words))
+
+
+class ElfGnuHashTable(ElfSection):
+    # .gnu.hash: nbuckets, symoffset, bloom_size, bloom_shift,
+    # bloom[bloom_size], buckets[nbuckets], chain[nsyms - symoffset]
+
+    BLOOM_SHIFT = 5
+
+    def __init__(self):
+        super(ElfGnuHashTable, self).__init__('.gnu.hash', 0x0, bytearray())
+
+    def set_link(self, link):
+        self.header.link = link               # index of .symtab
+
+    def order_symbols(self, global_symbols):
+        # stable, so any section / address ordering within a bucket is kept
+        nbuckets = choose_bucket_count(len(global_symbols))
+        return sorted(global_symbols,
+                      key=lambda symbol: gnu_hash(symbol[2]) % nbuckets)
+
+    def generate_content(self, symbol_table):
+        names = symbol_table.symbol_names
+        symoffset = symbol_table.header.info
+        hashes = [gnu_hash(name) for name in names[symoffset:]]
+
+        nbuckets = choose_bucket_count(len(hashes))
+        bloom_size = 1
+        while bloom_size * 32 < len(hashes):
+            bloom_size *= 2
+
+        bloom = [0] * bloom_size
+        buckets = [0] * nbuckets
+        chains = [h & ~1 for h in hashes]
+
+        for i, h in enumerate(hashes):
+            bloom[(h // 32) % bloom_size] |= ((1 << (h % 32)) |
+                (1 << ((h >> ElfGnuHashTable.BLOOM_SHIFT) % 32)))
+
+            bucket = h % nbuckets
+            if buckets[bucket] == 0:
+                buckets[bucket] = symoffset + i
+
+            # low bit marks the last symbol in a bucket's chain
+            if i + 1 == len(hashes) or hashes[i + 1] % nbuckets != bucket:
+                chains[i] |= 1
+
+        words = ([nbuckets, symoffset, bloom_size, ElfGnuHashTable.BLOOM_SHIFT] +
+                 bloom + buckets + chains)
+        self.append_to_content(pack('<%dI' % len(words), *words))
+
+
+def elf_hash(name):
+    h = 0
+    for c in name.encode('utf-8'):
+        h = (h << 4) + c
+        g = h & 0xf0000000
+        if g:
+            h ^= g >> 24
+        h &= ~g
+    return h & 0xffffffff
+
+def gnu_hash(name):
+    h = 5381
+    for c in name.encode('utf-8'):
+        h = (h * 33 + c) & 0xffffffff
+    return h
+
+# bucket counts used by binutils, keeps chains short without wasting space
+bucket_counts = [1, 3, 17, 37, 67, 97, 131, 197, 263, 521, 1031, 2053, 4099,
+                 8209, 16411, 32771, 65537, 131101, 262147]
+
+def choose_bucket_count(symbol_count):
+    best = bucket_counts[0]
+    for count in bucket_counts:
+        if count > symbol_count:
+            break
+        best = count
+    return best
+
+
 class SectionSettings(object):
     def __init__(self, type, addralign, flags):
         self.type = type
@@ -220,7 +413,9 @@ SHT_NULL     = 0
 SHT_PROGBITS = 1
 SHT_SYMTAB   = 2
 SHT_STRTAB   = 3
+SHT_HASH     = 5
 SHT_NOBITS   = 8
+SHT_GNU_HASH = 0x6ffffff6
 
 codeSettings = SectionSettings(type=SHT_PROGBITS, addralign=1, flags=0x6)
 dataSettings = SectionSettings(type=SHT_PROGBITS, addralign=1, flags=0x3)
@@ -234,5 +429,7 @@ default_section_settings = {
   '.irom0.text':   SectionSettings(type=SHT_PROGBITS, addralign=1, flags=0x6),
   '.bootrom.text': SectionSettings(type=SHT_PROGBITS, addralign=1, flags=0x6),
   '.shstrtab':     SectionSettings(type=SHT_STRTAB,   addralign=1, flags=0x0),
-  '.symtab':       SectionSettings(type=SHT_SYMTAB,   addralign=1, flags=0x0)
+  '.symtab':       SectionSettings(type=SHT_SYMTAB,   addralign=1, flags=0x0),
+  '.hash':         SectionSettings(type=SHT_HASH,     addralign=4, flags=0x0),
+  '.gnu.hash':     SectionSettings(type=SHT_GNU_HASH, addralign=4, flags=0x0)
 }
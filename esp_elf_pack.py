@@ -15,7 +15,9 @@
 # issues, but these workarounds have been removed and a simpler pack
 # function with fewer surprises is instead implemented here.
 
-from struct import pack
+from struct import Struct
+
+EI_NIDENT = 16
 
 Elf32_Ehdr = [
                          # unsigned char e_ident[EI_NIDENT]
@@ -78,17 +80,35 @@ e_ident = [
 ]
 
 def pack_elf(xtensa_elf):
-    packed_elf = pack_ident(xtensa_elf.ident)
-    packed_elf += pack_fileheader(xtensa_elf.fileHeader)
-
-    for header in xtensa_elf.sectionHeaders:
-        packed_elf += header.content
-
-    for header in xtensa_elf.sectionHeaders:
-        packed_elf += pack_section_header(header)
-
-    for header in xtensa_elf.programHeaders:
-        packed_elf += pack_program_header(header)
+    # size the whole file up front and pack everything into one buffer,
+    # section contents (often views into the rom) are copied exactly once.
+    # everything is placed at the offsets set by XtensaElf.generate_elf(),
+    # the buffer starts zeroed so alignment gaps are zero padding.
+    file_header = xtensa_elf.fileHeader
+    section_headers = xtensa_elf.sectionHeaders
+    program_headers = xtensa_elf.programHeaders
+
+    size = EI_NIDENT + _struct_for(Elf32_Ehdr).size
+    for header in section_headers:
+        size = max(size, header.offset + len(header.content))
+    size = max(size, file_header.shoff + _struct_for(Elf32_Shdr).size * len(section_headers))
+    size = max(size, file_header.phoff + _struct_for(Elf32_Phdr).size * len(program_headers))
+
+    packed_elf = bytearray(size)
+    offset = pack_ident_into(packed_elf, 0, xtensa_elf.ident)
+    _pack_struct_into(packed_elf, offset, file_header, Elf32_Ehdr)
+
+    for header in section_headers:
+        end = header.offset + len(header.content)
+        packed_elf[header.offset:end] = header.content
+
+    offset = file_header.shoff
+    for header in section_headers:
+        offset = _pack_struct_into(packed_elf, offset, header, Elf32_Shdr)
+
+    offset = file_header.phoff
+    for header in program_headers:
+        offset = _pack_struct_into(packed_elf, offset, header, Elf32_Phdr)
 
     return packed_elf
 
@@ -105,16 +125,35 @@ def pack_symbol(symbol):
     return _pack_struct(symbol, Elf32_Sym)
 
 def pack_ident(ident):
-    header = '\x7fELF'                     # magic number
-    header += _pack_struct(ident, e_ident) # pack fields in e_ident
-    return header + '\x00' * 9             # pad to 16 bytes
+    packed_ident = bytearray(EI_NIDENT)
+    pack_ident_into(packed_ident, 0, ident)
+    return bytes(packed_ident)
 
+def pack_ident_into(buf, offset, ident):
+    buf[offset:offset + 4] = b'\x7fELF'                  # magic number
+    _pack_struct_into(buf, offset + 4, ident, e_ident)    # pack fields in e_ident
+    return offset + EI_NIDENT                            # zero padded to 16 bytes
 
-def _pack_struct(struct, struct_fields):
-    packed = ''
 
-    for (field, size) in struct_fields:
-        field_value = getattr(struct, field)
-        packed += pack(size, field_value)
+_structs = {}
 
-    return packed
+def _struct_for(struct_fields):
+    # all fields are little endian, so each field list compiles down to a
+    # single Struct that packs every field in one call
+    key = tuple(struct_fields)
+
+    if key not in _structs:
+        fmt = '<' + ''.join(size.lstrip('<') for (field, size) in struct_fields)
+        _structs[key] = Struct(fmt)
+
+    return _structs[key]
+
+def _pack_struct(struct, struct_fields):
+    values = [getattr(struct, field) for (field, size) in struct_fields]
+    return _struct_for(struct_fields).pack(*values)
+
+def _pack_struct_into(buf, offset, struct, struct_fields):
+    compiled = _struct_for(struct_fields)
+    values = [getattr(struct, field) for (field, size) in struct_fields]
+    compiled.pack_into(buf, offset, *values)
+    return offset + compiled.size
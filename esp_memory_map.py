@@ -63,3 +63,8 @@ def is_data(address):
     if low and low.base_address == 0x3FFE8000:
         return True
     return False
+
+def find_regions_for_range(address, length):
+    end = address + max(length, 1)
+    return [region for region in memory_regions
+            if region.base_address < end and address < region.base_address + region.size]
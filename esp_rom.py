@@ -2,40 +2,41 @@
 #
 # MIT licence
 
-from esp_memory_map import find_region_for_address
+from esp_memory_map import find_region_for_address, find_regions_for_range
 
-from StringIO import StringIO
-from struct import pack, unpack
+from struct import unpack_from
+from time import monotonic
+
+# the largest flash chip an esp8266 supports is 16MB
+MAX_ROM_SIZE = 16 * 1024 * 1024
+READ_CHUNK_SIZE = 1024 * 1024
+
+IROM_ADDRESS = 0x40200000
 
 class EspRom(object):
-    def __init__(self, rom_name, rom_bytes_stream, flash_layout):
+    def __init__(self, rom_name, rom_bytes_stream, flash_layout, budget=None):
         self.name = rom_name
+        self.flash_layout = flash_layout
         self.sections = []
-        self.contents = rom_bytes_stream.read()
-        rom_bytes_stream.seek(0)
-
-        self.header = EspRomHeader.get_header(rom_bytes_stream)
-        if self.header.is_new():
-            # the new header format includes .irom0.text directly after,
-            # followed by an e9 header
-            irom_address = 0x40200000
-            irom_size = self.header.length
-            irom_text_contents = rom_bytes_stream.read(irom_size)
-            self.header = EspRomE9Header(rom_bytes_stream)
-        else:
-            # read the irom0.text section from flash, non-OTA case.
-            irom_section = flash_layout['.irom0.text']
-            irom_address = 0x40200000
-            irom_size = irom_section.size * 1024
-            limit = irom_section.offset + irom_size
-            irom_text_contents = self.contents[irom_section.offset:limit]
-
-        # add .irom0.text section
-        section = EspRomSection(StringIO(irom_text_contents), irom_address, irom_size)
-        self.sections.append(section)
-
-        for i in range(0, self.header.sect_count):
-            section = EspRomSection(rom_bytes_stream)
+
+        if budget is None:
+            budget = ParseBudget()
+        started = monotonic()
+
+        self.contents = read_bounded(rom_bytes_stream, budget, started)
+
+        # headers and sections are parsed at offsets into one view of the
+        # dump, so section contents share its buffer rather than copying
+        rom_view = memoryview(self.contents)
+
+        # check every header against the dump size and memory map before
+        # any section contents are touched
+        self.header, section_table = validate_rom_headers(
+            rom_view, flash_layout, budget, started)
+
+        # .irom0.text first, then the sections listed in the e9 header
+        for offset, address, length in section_table:
+            section = EspRomSection(rom_view, offset, address, length)
             self.sections.append(section)
 
     def __str__(self):
@@ -48,19 +49,151 @@ class EspRom(object):
         return rep
 
 
+class ParseBudget(object):
+    # limits for parsing a single dump, so that one bad input can't stall
+    # or exhaust the memory of a batch worker.
+    #
+    # max_seconds is checked between reads and between sections, it can't
+    # interrupt a read() that blocks.  files on disk (parse_rom) and archived
+    # dumps don't block; for pipes or sockets, set a timeout on the stream
+    # itself (e.g. socket.settimeout()) so a stalled read raises.
+
+    def __init__(self, max_bytes=MAX_ROM_SIZE, max_seconds=None):
+        self.max_bytes = max_bytes       # dump size and total section size
+        self.max_seconds = max_seconds   # None for no time limit
+
+    def check_size(self, size, context):
+        if size > self.max_bytes:
+            raise RomParseException(
+                "%s: %d bytes exceeds the budget of %d bytes."
+                    % (context, size, self.max_bytes))
+
+    def check_time(self, started, context):
+        if self.max_seconds is None:
+            return
+
+        elapsed = monotonic() - started
+        if elapsed > self.max_seconds:
+            raise RomParseException(
+                "%s: %.2f seconds exceeds the budget of %.2f seconds."
+                    % (context, elapsed, self.max_seconds))
+
+    def __str__(self):
+        rep = "ParseBudget("
+        rep += "max_bytes: %d, " % (self.max_bytes)
+        rep += "max_seconds: %s)" % (self.max_seconds)
+
+        return rep
+
+
+def read_bounded(rom_bytes_stream, budget, started):
+    # read in chunks so an oversized or slow stream fails once it goes over
+    # budget, rather than after it has been read into memory in full.  a
+    # read that never returns is the stream's own timeout to enforce.
+    contents = bytearray()
+
+    while True:
+        chunk = rom_bytes_stream.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+
+        contents += chunk
+        budget.check_size(len(contents), "read_bounded()")
+        budget.check_time(started, "read_bounded()")
+
+    return contents
+
+
+def validate_rom_headers(rom_view, flash_layout, budget, started):
+    # the one walk over a dump's headers, used by EspRom.  reads only the
+    # headers themselves and returns the e9 header along with
+    # (payload offset, address, length) for every section.
+    rom_size = len(rom_view)
+    header = EspRomHeader.get_header(rom_view, 0)
+    offset = header.ROM_HEADER_SIZE
+
+    if header.is_new():
+        # the new header format includes .irom0.text directly after,
+        # followed by an e9 header
+        irom_offset = offset
+        irom_size = header.length
+        _check_section(rom_size, irom_offset, IROM_ADDRESS, irom_size, '.irom0.text')
+
+        offset += irom_size
+        header = EspRomE9Header(rom_view, offset)
+        offset += EspRomE9Header.ROM_HEADER_SIZE
+    else:
+        # read the irom0.text section from flash, non-OTA case.
+        irom_section = flash_layout['.irom0.text']
+        irom_offset = irom_section.offset
+        irom_size = irom_section.size * 1024
+        _check_section(rom_size, irom_offset, IROM_ADDRESS, irom_size, '.irom0.text')
+
+    section_table = [(irom_offset, IROM_ADDRESS, irom_size)]
+    total_size = irom_size
+
+    # every section needs at least its own header
+    if header.sect_count * EspRomSection.SECTION_HEADER_SIZE > rom_size - offset:
+        raise RomParseException(
+            "validate_rom_headers(): sect_count %d can't fit in the remaining %d bytes."
+                % (header.sect_count, rom_size - offset))
+
+    for i in range(0, header.sect_count):
+        budget.check_time(started, "validate_rom_headers()")
+
+        if offset + EspRomSection.SECTION_HEADER_SIZE > rom_size:
+            raise RomParseException(
+                "validate_rom_headers(): section %d header at 0x%x is past the end of the rom."
+                    % (i, offset))
+
+        address, length = unpack_from('<II', rom_view, offset)
+        offset += EspRomSection.SECTION_HEADER_SIZE
+
+        _check_section(rom_size, offset, address, length, 'section %d' % (i))
+        section_table.append((offset, address, length))
+
+        offset += length
+        total_size += length
+
+    budget.check_size(total_size, "validate_rom_headers()")
+
+    return header, section_table
+
+
+def _check_section(rom_size, offset, address, length, name):
+    if offset + length > rom_size:
+        raise RomParseException(
+            "validate_rom_headers(): %s at 0x%x has length %d, only %d bytes remain."
+                % (name, offset, length, max(rom_size - offset, 0)))
+
+    if address + length > 0x100000000:
+        raise RomParseException(
+            "validate_rom_headers(): %s at 0x%08x with length %d wraps the address space."
+                % (name, address, length))
+
+    for region in find_regions_for_range(address, length):
+        if not region.permissions:
+            raise RomParseException(
+                "validate_rom_headers(): %s at 0x%08x overlaps the %s."
+                    % (name, address, region.description))
+
+
 class EspRomHeader(object):
     @staticmethod
-    def get_header(rom_bytes_stream):
-        header_type = rom_bytes_stream.read(1)
-        rom_bytes_stream.seek(-1, 1) # relative position
-
-        if header_type == '\xe9':
-            return EspRomE9Header(rom_bytes_stream)
-        elif header_type == '\xe4':
-            return EspRomE4Header(rom_bytes_stream)
+    def get_header(rom_view, offset):
+        if offset >= len(rom_view):
+            raise RomParseException(
+                "EspRomHeader.get_header: no header at offset 0x%x" % (offset))
+
+        header_type = rom_view[offset]
+
+        if header_type == 0xe9:
+            return EspRomE9Header(rom_view, offset)
+        elif header_type == 0xe4:
+            return EspRomE4Header(rom_view, offset)
         else:
             raise RomParseException(
-                "EspRomHeader.get_header: unrecognized magic_number %s"
+                "EspRomHeader.get_header: unrecognized magic_number 0x%02x"
                     % (header_type))
 
     def __init__(self):
@@ -70,7 +203,7 @@ class EspRomHeader(object):
 class EspRomE9Header(EspRomHeader):
     ROM_HEADER_SIZE = 8
 
-    def __init__(self, rom_bytes_stream):
+    def __init__(self, rom_view, offset):
         # typedef struct {
         #     uint8 magic;
         #     uint8 sect_count;
@@ -79,23 +212,20 @@ class EspRomE9Header(EspRomHeader):
         #     uint32 entry_addr;
         # } rom_header;
 
-        rom_header_bytes = rom_bytes_stream.read(EspRomE9Header.ROM_HEADER_SIZE)
+        rom_header_bytes = rom_view[offset:offset + EspRomE9Header.ROM_HEADER_SIZE]
 
         if len(rom_header_bytes) != EspRomE9Header.ROM_HEADER_SIZE:
             raise RomParseException(
                 "EspRomE9Header.init(): len(rom_header_bytes) is %d bytes != 8 bytes."
                     % (len(rom_header_bytes)))
 
-        if rom_header_bytes[0] != '\xe9':
+        if rom_header_bytes[0] != 0xe9:
             raise RomParseException(
-                "EspRomE9Header.init(): magic_number is %s != 0xe9."
+                "EspRomE9Header.init(): magic_number is 0x%02x != 0xe9."
                     % (rom_header_bytes[0]))
 
-        self.magic = unpack('<B', rom_header_bytes[0])[0]
-        self.sect_count = unpack('<B', rom_header_bytes[1])[0]
-        self.flags1 = unpack('<B', rom_header_bytes[2])[0]
-        self.flags2 = unpack('<B', rom_header_bytes[3])[0]
-        self.entry_addr = unpack('<I', rom_header_bytes[4:8])[0]
+        (self.magic, self.sect_count, self.flags1, self.flags2,
+            self.entry_addr) = unpack_from('<BBBBI', rom_header_bytes)
 
         super(EspRomE9Header, self).__init__()
 
@@ -116,7 +246,7 @@ class EspRomE9Header(EspRomHeader):
 class EspRomE4Header(EspRomHeader):
     ROM_HEADER_SIZE = 16
 
-    def __init__(self, rom_bytes_stream):
+    def __init__(self, rom_view, offset):
         # typedef struct {
         #     uint8 magic1;
         #     uint8 magic2;
@@ -126,29 +256,28 @@ class EspRomE4Header(EspRomHeader):
         #     uint32 length;
         # } rom_header;
 
-        rom_header_bytes = rom_bytes_stream.read(EspRomE4Header.ROM_HEADER_SIZE)
+        rom_header_bytes = rom_view[offset:offset + EspRomE4Header.ROM_HEADER_SIZE]
 
         if len(rom_header_bytes) != EspRomE4Header.ROM_HEADER_SIZE:
             raise RomParseException(
                 "EspRomE4Header.init(): len(rom_header_bytes) is %d bytes != 16 bytes."
                     % (len(rom_header_bytes)))
 
-        if rom_header_bytes[0] != '\xe4':
+        if rom_header_bytes[0] != 0xe4:
             raise RomParseException(
-                "EspRomE4Header.init(): magic1 is %s != 0xe4."
+                "EspRomE4Header.init(): magic1 is 0x%02x != 0xe4."
                     % (rom_header_bytes[0]))
 
-        if rom_header_bytes[1] != '\x04':
+        if rom_header_bytes[1] != 0x04:
             raise RomParseException(
-                "EspRomE4Header.init(): magic2 is %s != 0x04."
+                "EspRomE4Header.init(): magic2 is 0x%02x != 0x04."
                     % (rom_header_bytes[1]))
 
-        self.magic1 = unpack('<B', rom_header_bytes[0])[0]
-        self.magic2 = unpack('<B', rom_header_bytes[1])[0]
-        self.config = unpack('<BB', rom_header_bytes[2:4])
-        self.entry_addr = unpack('<I', rom_header_bytes[4:8])[0]
-        self.unused = unpack('<BBBB', rom_header_bytes[8:12])
-        self.length = unpack('<I', rom_header_bytes[12:16])[0]
+        self.magic1, self.magic2 = unpack_from('<BB', rom_header_bytes, 0)
+        self.config = unpack_from('<BB', rom_header_bytes, 2)
+        self.entry_addr = unpack_from('<I', rom_header_bytes, 4)[0]
+        self.unused = unpack_from('<BBBB', rom_header_bytes, 8)
+        self.length = unpack_from('<I', rom_header_bytes, 12)[0]
 
         super(EspRomE4Header, self).__init__()
 
@@ -170,29 +299,31 @@ class EspRomE4Header(EspRomHeader):
 class EspRomSection(object):
     SECTION_HEADER_SIZE = 8
 
-    def __init__(self, rom_bytes_stream, address=None, length=None):
+    def __init__(self, rom_view, offset, address=None, length=None):
         # typedef struct {
         #     uint32 address;
         #     uint32 length;
         # } sect_header;
 
-        if not address or not length:
-            section_header_bytes = rom_bytes_stream.read(EspRomSection.SECTION_HEADER_SIZE)
+        if address is None:
+            limit = offset + EspRomSection.SECTION_HEADER_SIZE
+            section_header_bytes = rom_view[offset:limit]
 
             if len(section_header_bytes) != EspRomSection.SECTION_HEADER_SIZE:
                 raise RomParseException(
                     "EspRomSection.init(): section_header_bytes is %d bytes != 8 bytes."
                         % (len(section_header_bytes)))
 
-            self.address = unpack('<I', section_header_bytes[0:4])[0]
-            self.length = unpack('<I', section_header_bytes[4:8])[0]
+            self.address, self.length = unpack_from('<II', section_header_bytes)
+            offset = limit
 
         else:
-            # support specified length and address for non-OTA case and new header
+            # address and length already known, e.g. from validate_rom_headers()
             self.address = address
             self.length = length
 
-        self.contents = rom_bytes_stream.read(self.length)
+        self.contents = rom_view[offset:offset + self.length]
+        self.end_offset = offset + self.length
 
         if len(self.contents) != self.length:
             raise RomParseException(
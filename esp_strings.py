@@ -0,0 +1,69 @@
+# esp-bin2elf written by Joel Sandin <jsandin@gmail.com>
+#
+# MIT licence
+
+# Finds printable NUL-terminated strings (format strings, identifiers, ...)
+# in rom sections.  The byte-class scan is a single compiled regex run over
+# each section's contents, so the matching happens in C rather than in a
+# per-byte python loop.  The regex is a bare character class so the regex
+# engine can skip non-printable bytes quickly, each run is matched once and
+# the NUL terminator is checked afterwards.
+
+import re
+
+MIN_STRING_LENGTH = 4
+
+_string_res = {}
+
+def _string_re(min_length):
+    if min_length not in _string_res:
+        _string_res[min_length] = re.compile(
+            (r'[\t\n\r\x20-\x7e]{%d,}' % (min_length)).encode('ascii'))
+    return _string_res[min_length]
+
+
+class EspRomString(object):
+    def __init__(self, address, string):
+        self.address = address
+        self.string = string
+
+    def symbol_name(self):
+        # readable but unique: a sanitized prefix of the string + address
+        prefix = re.sub(r'[^A-Za-z0-9]+', '_', self.string[:24]).strip('_')
+        return "s_%s_%08x" % (prefix, self.address)
+
+    def __str__(self):
+        rep = "EspRomString("
+        rep += "address: 0x%08x, " % (self.address)
+        rep += "string: %r)" % (self.string)
+
+        return rep
+
+
+def find_strings(esp_rom_section, min_length=MIN_STRING_LENGTH):
+    string_re = _string_re(min_length)
+    address = esp_rom_section.address
+    contents = esp_rom_section.contents
+    size = len(contents)
+
+    return [EspRomString(address + match.start(), match.group().decode('ascii'))
+            for match in string_re.finditer(contents)
+            if match.end() < size and contents[match.end()] == 0]
+
+
+def find_rom_strings(esp_rom, min_length=MIN_STRING_LENGTH):
+    rom_strings = []
+
+    for section in esp_rom.sections:
+        rom_strings.extend(find_strings(section, min_length))
+
+    return rom_strings
+
+
+def build_string_index(rom_strings):
+    string_to_addresses = {}
+
+    for rom_string in rom_strings:
+        string_to_addresses.setdefault(rom_string.string, []).append(rom_string.address)
+
+    return string_to_addresses
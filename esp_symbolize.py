@@ -0,0 +1,320 @@
+# esp-bin2elf written by Joel Sandin <jsandin@gmail.com>
+#
+# MIT licence
+
+# Symbolizes esp8266 exception dumps against a converted ELF.
+#
+# A crash report printed by the SDK looks something like:
+#
+#   Fatal exception (28):
+#   epc1=0x40201234, epc2=0x00000000, epc3=0x00000000, excvaddr=0x00000000, depc=0x00000000
+#
+#   >>>stack>>>
+#   3ffffdb0:  40201234 00000000 3ffe8000 4000444c
+#   <<<stack<<<
+#
+# Every register value and stack word is resolved to symbol+offset, the
+# ELF section containing it and the memory region from esp_memory_map.
+# Lookups go through a sorted address index (bisect).  Results for addresses
+# inside a section are memoized in a bounded LRU, since the same few code
+# addresses repeat across a fleet's logs while most stack words are data.
+
+import re
+import sys
+
+from bisect import bisect_right
+from functools import lru_cache
+from struct import calcsize, unpack_from
+
+from esp_elf_pack import Elf32_Ehdr, Elf32_Shdr, Elf32_Sym
+from esp_memory_map import find_region_for_address
+
+SHT_SYMTAB = 2
+STT_OBJECT = 1
+
+DEFAULT_CACHE_SIZE = 64 * 1024
+
+class SymbolIndex(object):
+    def __init__(self, cache_size=DEFAULT_CACHE_SIZE):
+        self.symbols = []           # (address, name), functions and untyped
+        self.objects = []           # (address, end, name), sized data objects
+        self.sections = []          # (address, end, name)
+        self.symbol_addresses = []
+        self.object_addresses = []
+        self.section_addresses = []
+        self.cache_size = cache_size
+        self.cached_lookup = lru_cache(maxsize=cache_size)(self._lookup_in_section)
+
+    @staticmethod
+    def from_xtensa_elf(xtensa_elf, cache_size=DEFAULT_CACHE_SIZE):
+        index = SymbolIndex(cache_size)
+
+        for section in xtensa_elf.sections:
+            header = section.header
+            index.add_section(header.name, header.addr, header.section_size)
+
+        for symbol in xtensa_elf.symbol_table.symbols:
+            name, address, section_name, binding, symbol_type, size = symbol
+            index.add_symbol(name, address, symbol_type, size)
+
+        index.finalize()
+        return index
+
+    @staticmethod
+    def from_elf_file(elf_filename, cache_size=DEFAULT_CACHE_SIZE):
+        with open(elf_filename, 'rb') as f:
+            elf_bytes = f.read()
+
+        index = SymbolIndex(cache_size)
+
+        file_header = _unpack_struct(elf_bytes, 16, Elf32_Ehdr)
+        section_headers = []
+
+        for i in range(file_header.shnum):
+            offset = file_header.shoff + i * file_header.shentsize
+            section_headers.append(_unpack_struct(elf_bytes, offset, Elf32_Shdr))
+
+        shstrtab = section_headers[file_header.shstrndx]
+
+        for header in section_headers:
+            name = _read_string(elf_bytes, shstrtab.offset + header.nameoffset)
+            index.add_section(name, header.addr, header.section_size)
+
+            if header.type != SHT_SYMTAB:
+                continue
+
+            strtab = section_headers[header.link]
+
+            # skip the null symbol at index 0
+            for offset in range(header.offset + header.entsize,
+                                header.offset + header.section_size, header.entsize):
+                symbol = _unpack_struct(elf_bytes, offset, Elf32_Sym)
+                name = _read_string(elf_bytes, strtab.offset + symbol.st_name)
+                index.add_symbol(name, symbol.st_value, symbol.st_info & 0xf,
+                                 symbol.st_size)
+
+        index.finalize()
+        return index
+
+    def add_symbol(self, name, address, symbol_type=None, size=0):
+        # data objects (e.g. strings) only cover their own bytes, keeping
+        # them apart stops code after a string resolving to the string
+        if symbol_type == STT_OBJECT:
+            self.objects.append((address, address + size, name))
+        else:
+            self.symbols.append((address, name))
+
+    def add_section(self, name, address, size):
+        # sections without an address (null, string and symbol tables) are
+        # not loaded, so addresses can never resolve to them
+        if address and size:
+            self.sections.append((address, address + size, name))
+
+    def finalize(self):
+        self.symbols.sort()
+        self.objects.sort()
+        self.sections.sort()
+        self.symbol_addresses = [address for address, name in self.symbols]
+        self.object_addresses = [address for address, end, name in self.objects]
+        self.section_addresses = [address for address, end, name in self.sections]
+        self.cached_lookup.cache_clear()
+
+    def find_section(self, address):
+        i = bisect_right(self.section_addresses, address) - 1
+        if i >= 0:
+            section_address, section_end, name = self.sections[i]
+            if address < section_end:
+                return section_address, name
+        return None, None
+
+    def lookup(self, address):
+        section_address, section_name = self.find_section(address)
+
+        # addresses outside every section (mostly stack data) aren't
+        # memoized, there are too many distinct ones and they're cheap
+        if section_name is None:
+            region, next_region = find_region_for_address(address)
+            return SymbolizedAddress(address, None, None, None, region)
+
+        return self.cached_lookup(address, section_address, section_name)
+
+    def _lookup_in_section(self, address, section_address, section_name):
+        symbol_name, symbol_offset = None, None
+
+        # a data object only matches addresses within its own size
+        i = bisect_right(self.object_addresses, address) - 1
+        if i >= 0 and address < self.objects[i][1]:
+            symbol_address, end, symbol_name = self.objects[i]
+            symbol_offset = address - symbol_address
+
+        # otherwise take the nearest symbol if it lives in the same section,
+        # else a .irom0.text address would resolve to a bootrom symbol
+        else:
+            i = bisect_right(self.symbol_addresses, address) - 1
+            if i >= 0 and self.symbol_addresses[i] >= section_address:
+                symbol_address, symbol_name = self.symbols[i]
+                symbol_offset = address - symbol_address
+
+        region, next_region = find_region_for_address(address)
+
+        return SymbolizedAddress(address, symbol_name, symbol_offset,
+                                 section_name, region)
+
+    def lookup_many(self, addresses):
+        return [self.lookup(address) for address in addresses]
+
+    def __str__(self):
+        rep = "SymbolIndex("
+        rep += "len(symbols): %d, " % (len(self.symbols))
+        rep += "len(objects): %d, " % (len(self.objects))
+        rep += "len(sections): %d)" % (len(self.sections))
+
+        return rep
+
+
+class SymbolizedAddress(object):
+    def __init__(self, address, symbol_name, symbol_offset, section_name, region):
+        self.address = address
+        self.symbol_name = symbol_name
+        self.symbol_offset = symbol_offset
+        self.section_name = section_name
+        self.region = region
+
+    def symbol(self):
+        if self.symbol_name is None:
+            return None
+        return "%s+0x%x" % (self.symbol_name, self.symbol_offset)
+
+    def __str__(self):
+        rep = "0x%08x" % (self.address)
+
+        if self.symbol_name is not None:
+            rep += " %s" % (self.symbol())
+        if self.section_name is not None:
+            rep += " [%s]" % (self.section_name)
+        if self.region is not None:
+            rep += " (%s)" % (self.region.description)
+
+        return rep
+
+
+class CrashReport(object):
+    def __init__(self, exception_cause=None):
+        self.exception_cause = exception_cause
+        self.registers = []    # (name, address)
+        self.stack = []        # (stack address, word)
+
+    def addresses(self):
+        return ([address for name, address in self.registers] +
+                [word for stack_address, word in self.stack])
+
+    def __str__(self):
+        rep = "CrashReport("
+        rep += "exception_cause: %s, " % (self.exception_cause)
+        rep += "len(registers): %d, " % (len(self.registers))
+        rep += "len(stack): %d)" % (len(self.stack))
+
+        return rep
+
+
+exception_re = re.compile(r'exception \((\d+)\)', re.IGNORECASE)
+register_re = re.compile(r'\b(epc\d|excvaddr|depc)=(?:0x)?([0-9a-fA-F]{1,8})\b')
+stack_line_re = re.compile(r'^\s*([0-9a-fA-F]{8}):((?:\s+[0-9a-fA-F]{8})+)\s*$')
+
+def parse_crash_reports(lines):
+    reports = []
+    report = None
+    in_stack = False
+
+    for line in lines:
+        match = exception_re.search(line)
+        if match:
+            report = CrashReport(int(match.group(1)))
+            reports.append(report)
+            in_stack = False
+            continue
+
+        if '>>>stack>>>' in line:
+            if report is None:
+                report = CrashReport()
+                reports.append(report)
+            in_stack = True
+            continue
+
+        if '<<<stack<<<' in line:
+            in_stack = False
+            report = None
+            continue
+
+        if in_stack:
+            match = stack_line_re.match(line)
+            if match:
+                stack_address = int(match.group(1), 16)
+                for i, word in enumerate(match.group(2).split()):
+                    report.stack.append((stack_address + i * 4, int(word, 16)))
+            continue
+
+        registers = register_re.findall(line)
+        if registers:
+            if report is None:
+                report = CrashReport()
+                reports.append(report)
+            for name, value in registers:
+                report.registers.append((name, int(value, 16)))
+
+    return reports
+
+
+def symbolize_crash_log(symbol_index, crash_log_filename):
+    # serial logs often contain line noise, don't fail on it
+    with open(crash_log_filename, errors='replace') as f:
+        reports = parse_crash_reports(f)
+
+    return [(report, symbol_index.lookup_many(report.addresses()))
+            for report in reports]
+
+
+def _unpack_struct(buf, offset, struct_fields):
+    struct = ElfStruct()
+
+    for (field, size) in struct_fields:
+        setattr(struct, field, unpack_from(size, buf, offset)[0])
+        offset += calcsize(size)
+
+    return struct
+
+
+class ElfStruct(object):
+    pass
+
+
+def _read_string(buf, offset):
+    end = buf.index(b'\x00', offset)
+    return buf[offset:end].decode('utf-8')
+
+
+def main(argv):
+    if len(argv) < 3:
+        print("usage: %s firmware.elf crash.log [crash.log ...]" % (argv[0]))
+        return 1
+
+    symbol_index = SymbolIndex.from_elf_file(argv[1])
+
+    for crash_log_filename in argv[2:]:
+        for report, results in symbolize_crash_log(symbol_index, crash_log_filename):
+            print("%s: exception (%s)" % (crash_log_filename, report.exception_cause))
+
+            for (name, address), result in zip(report.registers, results):
+                print("  %-8s %s" % (name, result))
+
+            stack_results = results[len(report.registers):]
+            for (stack_address, word), result in zip(report.stack, stack_results):
+                # most stack words are plain data, only show resolved ones
+                if result.section_name is not None:
+                    print("  %08x %s" % (stack_address, result))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -43,7 +43,7 @@ ota_slot_one = {
 }
 
 def make_slot_two_layout(flash_size):
-    halfway_point = flash_size / 2
+    halfway_point = flash_size // 2
     text_off = halfway_point + 0x1000
     irom_off = text_off + (64 * 1024)
 